@@ -1,10 +1,16 @@
 import asyncio
 import logging
 import sqlite3
-from datetime import datetime
+import threading
+from contextlib import contextmanager
+from collections.abc import Iterable
+from datetime import datetime, time
+from zoneinfo import ZoneInfo
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest, ChatMigrated, Forbidden
 from telegram.ext import (
     Application,
+    AIORateLimiter,
     ApplicationBuilder,
     ContextTypes,
     CommandHandler,
@@ -13,20 +19,13 @@ from telegram.ext import (
     ChatMemberHandler,
     CallbackQueryHandler
 )
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
-import nest_asyncio
 import os
-import pytz
 from dotenv import load_dotenv
-import random
 
 # Configuração do logger
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Aplicar patch para suportar loop reentrante
-nest_asyncio.apply()
-
 # === CONFIG ===
 load_dotenv()
 
@@ -37,61 +36,160 @@ if not BOT_TOKEN or not ADMIN_ID:
     logger.error("BOT_TOKEN e/ou ADMIN_ID não definidos nas variáveis de ambiente!")
     exit(1)
 
+# Canal privado opcional onde a mensagem programada é publicada uma vez; os
+# envios passam a ser cópias dessa mensagem (copy_message)
+SOURCE_CHAT_ID = int(os.getenv("SOURCE_CHAT_ID")) if os.getenv("SOURCE_CHAT_ID") else None
+
 # Definir o fuso horário de Brasília (GMT-3)
-brasilia_tz = pytz.timezone('America/Sao_Paulo')
+brasilia_tz = ZoneInfo('America/Sao_Paulo')
+
+# Mensagens enviadas pelo bot
+WELCOME_TEXT = (
+    "🎉 Olá! Eu sou o bot responsável por ajudar a gerenciar e promover seu canal!\n\n"
+    "Agora que você me adicionou como administrador, eu posso enviar mensagens programadas para o seu canal.\n"
+    "Fique atento às instruções e aproveite todos os benefícios!"
+)
+BROADCAST_TEXT = "Aqui estão os canais disponíveis..."
+
+# Teclado do /start, montado uma única vez
+START_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("Cadastrar meu canal", callback_data='cadastrar_canal'),
+        InlineKeyboardButton("Como funciona o bot?", callback_data='como_funciona'),
+    ]
+])
 
 # Banco de dados SQLite para persistência
-def get_db_connection():
-    conn = sqlite3.connect('bot_data.db')
-    conn.row_factory = sqlite3.Row  # Facilita o acesso aos dados como dicionários
-    return conn
+# Uma única conexão é mantida aberta durante toda a execução do bot, preservando
+# o cache de páginas do SQLite entre as chamadas. Ela é aberta por create_tables()
+# e fechada por close_db(), o que permite reiniciar o bot no mesmo processo. O lock
+# serializa as escritas, já que o agendador e os handlers compartilham a conexão.
+_CONN: sqlite3.Connection | None = None
+_DB_LOCK = threading.Lock()
+
+def _abrir_db():
+    # Chamada com _DB_LOCK adquirido
+    global _CONN
+    if _CONN is not None:
+        return
+    _CONN = sqlite3.connect(
+        'bot_data.db',
+        check_same_thread=False,
+        isolation_level=None,
+        cached_statements=128,
+    )
+    _CONN.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-64000;
+    """)
+
+@contextmanager
+def _transacao():
+    # Transação explícita (a conexão está em autocommit); desfaz tudo em caso de erro
+    with _DB_LOCK:
+        _CONN.execute("BEGIN")
+        try:
+            yield _CONN
+        except BaseException:
+            _CONN.execute("ROLLBACK")
+            raise
+        _CONN.execute("COMMIT")
 
-def close_db_connection(conn):
-    conn.close()
+def close_db():
+    global _CONN
+    with _DB_LOCK:
+        if _CONN is not None:
+            _CONN.close()
+            _CONN = None
+
+# Consultas usadas no caminho quente; o mesmo texto é sempre reutilizado para
+# aproveitar o cache de statements preparados da conexão
+SQL_UPSERT = (
+    "INSERT INTO canais (chat_id, last_interaction_date) VALUES (?, ?) "
+    "ON CONFLICT(chat_id) DO UPDATE SET "
+    "last_interaction_date = COALESCE(excluded.last_interaction_date, canais.last_interaction_date)"
+)
+SQL_GET_LAST = "SELECT last_interaction_date FROM canais WHERE chat_id = ?"
+SQL_DELETE = "DELETE FROM canais WHERE chat_id = ?"
+SQL_LIST_PENDING = (
+    "SELECT chat_id FROM canais WHERE last_interaction_date IS NULL OR last_interaction_date < ?"
+)
+
+# As datas são gravadas como dia ordinal (date.toordinal()); bancos antigos
+# guardavam o texto "YYYY-MM-DD" e são convertidos na inicialização
+def _migrar_datas_texto():
+    colunas = {row[1]: row[2] for row in _CONN.execute("PRAGMA table_info(canais)")}
+    if colunas.get("last_interaction_date") != "TEXT":
+        return
+    # Chamada com _DB_LOCK adquirido (por create_tables), por isso sem _transacao()
+    _CONN.execute("BEGIN")
+    try:
+        _CONN.execute("""
+            CREATE TABLE canais_novo (
+                chat_id INTEGER PRIMARY KEY,
+                last_interaction_date INTEGER
+            )
+        """)
+        # Valores que não são datas válidas viram NULL (o canal recebe o próximo envio)
+        _CONN.execute("""
+            INSERT INTO canais_novo (chat_id, last_interaction_date)
+                SELECT chat_id, CAST(julianday(last_interaction_date) - 1721424.5 AS INTEGER)
+                FROM canais
+        """)
+        _CONN.execute("DROP TABLE canais")
+        _CONN.execute("ALTER TABLE canais_novo RENAME TO canais")
+    except BaseException:
+        _CONN.execute("ROLLBACK")
+        raise
+    _CONN.execute("COMMIT")
+    logger.info("Coluna last_interaction_date convertida para INTEGER.")
 
 # Função para criar a tabela canais caso não exista
 def create_tables():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS canais (
-            chat_id INTEGER PRIMARY KEY,
-            last_interaction_date TEXT
-        )
-    """)
-    conn.commit()
-    close_db_connection(conn)
+    with _DB_LOCK:
+        _abrir_db()
+        _CONN.execute("""
+            CREATE TABLE IF NOT EXISTS canais (
+                chat_id INTEGER PRIMARY KEY,
+                last_interaction_date INTEGER
+            )
+        """)
+        _migrar_datas_texto()
+        _CONN.execute("CREATE INDEX IF NOT EXISTS idx_last ON canais(last_interaction_date)")
 
 # Funções de persistência
-def get_last_interaction_date(canal_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_interaction_date FROM canais WHERE chat_id = ?", (canal_id,))
-    result = cursor.fetchone()
-    close_db_connection(conn)
-    return result[0] if result else None
+def _upsert_canal(canal_id, date):
+    # Registra o canal ou atualiza a data; uma data nula preserva a já gravada
+    with _DB_LOCK:
+        _CONN.execute(SQL_UPSERT, (canal_id, date))
 
 def update_last_interaction_date(canal_id, date):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("UPDATE canais SET last_interaction_date = ? WHERE chat_id = ?", (date, canal_id))
-    conn.commit()
-    close_db_connection(conn)
+    _upsert_canal(canal_id, date)
 
 def add_canal(chat_id):
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("INSERT OR IGNORE INTO canais (chat_id) VALUES (?)", (chat_id,))
-    conn.commit()
-    close_db_connection(conn)
-
-def get_canais():
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM canais")
-    canais = cursor.fetchall()
-    close_db_connection(conn)
-    return canais
+    _upsert_canal(chat_id, None)
+
+def add_canais(ids: Iterable[int]):
+    # Registra vários canais em uma única transação (um só fsync)
+    with _transacao() as conn:
+        conn.executemany(SQL_UPSERT, [(chat_id, None) for chat_id in ids])
+
+def remove_canal(chat_id):
+    with _DB_LOCK:
+        _CONN.execute(SQL_DELETE, (chat_id,))
+
+def migrar_canal(chat_id, new_chat_id):
+    # O grupo virou supergrupo: mantém o registro sob o novo chat_id
+    with _transacao() as conn:
+        row = conn.execute(SQL_GET_LAST, (chat_id,)).fetchone()
+        conn.execute(SQL_DELETE, (chat_id,))
+        conn.execute(SQL_UPSERT, (new_chat_id, row[0] if row else None))
+
+def iter_chat_ids_pendentes(today):
+    # Somente os canais que ainda não receberam a mensagem no dia
+    return (row[0] for row in _CONN.execute(SQL_LIST_PENDING, (today,)))
 
 # Função que será chamada sempre que o bot for adicionado a um novo canal
 async def on_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -106,59 +204,106 @@ async def on_chat_member_update(update: Update, context: ContextTypes.DEFAULT_TY
 
 # Função que envia a mensagem de boas-vindas para o novo canal
 async def send_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    # Mensagem de boas-vindas
-    welcome_text = (
-        "🎉 Olá! Eu sou o bot responsável por ajudar a gerenciar e promover seu canal!\n\n"
-        "Agora que você me adicionou como administrador, eu posso enviar mensagens programadas para o seu canal.\n"
-        "Fique atento às instruções e aproveite todos os benefícios!"
-    )
     try:
         # Enviar a mensagem de boas-vindas para o canal
-        await context.bot.send_message(chat_id, welcome_text)
+        await context.bot.send_message(chat_id, WELCOME_TEXT)
         # Registrar o canal no banco de dados
         add_canal(chat_id)
-        logger.info(f"Canal {chat_id} registrado com sucesso!")
+        logger.info("Canal %s registrado com sucesso!", chat_id)
     except Exception as e:
-        logger.error(f"Erro ao enviar mensagem de boas-vindas para o canal {chat_id}: {e}")
+        logger.error("Erro ao enviar mensagem de boas-vindas para o canal %s: %s", chat_id, e)
 
-# Função para enviar a mensagem programada com limitação de requisições
-async def enviar_mensagem_programada(bot):
-    canais = get_canais()
-    for canal in canais:
-        canal_id = canal[0]
-
-        # Verificar a última interação e garantir que não houve envio no mesmo dia
-        last_interaction = get_last_interaction_date(canal_id)
-        today = datetime.now().strftime("%Y-%m-%d")
-        if last_interaction == today:
-            logger.info(f"Canal {canal_id} já foi atualizado hoje.")
-            continue  # Se já foi interagido hoje, pula para o próximo canal
-
-        # Pausar entre os envios para evitar múltiplos pedidos em sequência
-        await asyncio.sleep(random.randint(5, 10))  # Pausa aleatória entre 5 e 10 segundos
-
-        # Enviar a mensagem com a lista de canais
+# Máximo de envios simultâneos; o ritmo é controlado pelo AIORateLimiter do bot
+send_semaphore = asyncio.Semaphore(25)
+
+# (chat_id, message_id) da mensagem publicada em SOURCE_CHAT_ID
+_broadcast_source: tuple[int, int] | None = None
+
+# Publica a mensagem programada no canal de origem, se houver um configurado
+async def publicar_mensagem_origem(bot):
+    global _broadcast_source
+    if SOURCE_CHAT_ID is None:
+        return
+    try:
+        message = await bot.send_message(chat_id=SOURCE_CHAT_ID, text=BROADCAST_TEXT)
+        _broadcast_source = (SOURCE_CHAT_ID, message.message_id)
+    except Exception as e:
+        logger.error("Erro ao publicar a mensagem no canal de origem %s: %s", SOURCE_CHAT_ID, e)
+
+# Erros do copy_message que só podem vir da mensagem de origem
+_ERROS_ORIGEM = ("message to copy not found", "message_id_invalid")
+
+# Copia a mensagem de origem quando houver uma; senão envia o texto
+async def _enviar_mensagem(bot, canal_id):
+    global _broadcast_source
+    if not _broadcast_source:
+        await bot.send_message(chat_id=canal_id, text=BROADCAST_TEXT)
+        return
+
+    from_chat_id, message_id = _broadcast_source
+    try:
+        await bot.copy_message(
+            chat_id=canal_id,
+            from_chat_id=from_chat_id,
+            message_id=message_id,
+        )
+    except (Forbidden, BadRequest) as e:
+        erro = e.message.lower()
+        if isinstance(e, BadRequest) and any(origem in erro for origem in _ERROS_ORIGEM):
+            # A mensagem de origem foi apagada: a próxima execução publica outra
+            _broadcast_source = None
+            logger.warning("Mensagem de origem indisponível, usando send_message: %s", e)
+            await bot.send_message(chat_id=canal_id, text=BROADCAST_TEXT)
+        elif isinstance(e, Forbidden) or "chat not found" in erro:
+            # Pode ser o canal ou a origem: o send_message decide. Se ele falhar, o
+            # erro é do canal e segue o tratamento normal de _send_one
+            await bot.send_message(chat_id=canal_id, text=BROADCAST_TEXT)
+            _broadcast_source = None
+            logger.warning("Canal de origem %s inacessível, usando send_message: %s", from_chat_id, e)
+        else:
+            raise
+
+# Envia a mensagem programada para um único canal
+async def _send_one(bot, canal_id, today):
+    async with send_semaphore:
         try:
-            await bot.send_message(
-                chat_id=canal_id,
-                text="Aqui estão os canais disponíveis...",
-            )
-            update_last_interaction_date(canal_id, today)
+            await _enviar_mensagem(bot, canal_id)
+        except Forbidden as e:
+            # O bot foi removido do canal: não adianta tentar de novo
+            remove_canal(canal_id)
+            logger.warning("Canal %s removido (sem permissão de envio): %s", canal_id, e)
+        except ChatMigrated as e:
+            migrar_canal(canal_id, e.new_chat_id)
+            logger.info("Canal %s migrado para %s.", canal_id, e.new_chat_id)
+        except BadRequest as e:
+            if "chat not found" in e.message.lower():
+                remove_canal(canal_id)
+                logger.warning("Canal %s removido (chat não encontrado): %s", canal_id, e)
+            else:
+                logger.error("Erro ao enviar para %s: %s", canal_id, e)
         except Exception as e:
-            logger.error(f"Erro ao enviar para {canal_id}: {e}")
-            # Espera antes de tentar novamente
-            await asyncio.sleep(10)
+            logger.error("Erro ao enviar para %s: %s", canal_id, e)
+        else:
+            update_last_interaction_date(canal_id, today)
+
+# Função para enviar a mensagem programada com limitação de requisições
+async def enviar_mensagem_programada(context: ContextTypes.DEFAULT_TYPE):
+    bot = context.bot
+    today = datetime.now(brasilia_tz).date().toordinal()
+    if _broadcast_source is None:
+        # Publica a mensagem de origem de novo se ela se perdeu desde a última execução
+        await publicar_mensagem_origem(bot)
+    canais = list(iter_chat_ids_pendentes(today))
+    tasks = [asyncio.create_task(_send_one(bot, canal_id, today)) for canal_id in canais]
+    resultados = await asyncio.gather(*tasks, return_exceptions=True)
+    # Falhas fora do tratamento de _send_one (ex.: erro do SQLite ao gravar a data)
+    for canal_id, resultado in zip(canais, resultados):
+        if isinstance(resultado, BaseException):
+            logger.error("Erro ao processar o canal %s: %r", canal_id, resultado)
 
 # Função para iniciar o bot
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [
-            InlineKeyboardButton("Cadastrar meu canal", callback_data='cadastrar_canal'),
-            InlineKeyboardButton("Como funciona o bot?", callback_data='como_funciona'),
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text("Bem-vindo! Como posso te ajudar hoje?", reply_markup=reply_markup)
+    await update.message.reply_text("Bem-vindo! Como posso te ajudar hoje?", reply_markup=START_MARKUP)
 
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
@@ -169,9 +314,68 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif query.data == 'como_funciona':
         await query.edit_message_text("Eu ajudo a gerenciar canais, enviar mensagens programadas, e muito mais!")
 
-# Inicializando o agendador corretamente
-scheduler = AsyncIOScheduler()  # Agora o scheduler é inicializado corretamente
+# Prepara a mensagem de origem assim que o bot inicia
+async def post_init(app: Application):
+    await publicar_mensagem_origem(app.bot)
+
+# Fecha a conexão com o banco quando o bot é encerrado
+async def post_shutdown(app: Application):
+    close_db()
+
+# Application única do bot, criada sob demanda por build_app()
+APP: Application | None = None
+
+# Monta a Application (handlers e agendamentos) apenas uma vez
+def build_app() -> Application:
+    global APP
+    if APP is not None:
+        return APP
+
+    # O AIORateLimiter respeita os limites do Telegram (30 msg/s no total e
+    # 20 msg/min por grupo) e tenta novamente quando a API responde com 429
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        # Pool HTTP com folga para os envios simultâneos da mensagem programada
+        .connection_pool_size(32)
+        .pool_timeout(30)
+        .read_timeout(30)
+        .write_timeout(30)
+        .connect_timeout(15)
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=30,
+            overall_time_period=1,
+            group_max_rate=20,
+            group_time_period=60,
+            max_retries=3,
+        ))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(CallbackQueryHandler(button))
+    app.add_handler(ChatMemberHandler(on_chat_member_update, ChatMemberHandler.CHAT_MEMBER))
+
+    # Agendar os envios diários (horário de Brasília)
+    for hour, minute in [(9, 0), (12, 0), (18, 0), (21, 30)]:
+        app.job_queue.run_daily(
+            enviar_mensagem_programada,
+            time=time(hour, minute, tzinfo=brasilia_tz),
+        )
+
+    APP = app
+    return APP
 
 # Main
-async def main():
-    logger.info("Iniciando o bot
+def main():
+    logger.info("Iniciando o bot...")
+
+    create_tables()
+
+    app = build_app()
+    app.run_polling(allowed_updates=Update.ALL_TYPES)
+
+if __name__ == "__main__":
+    main()